@@ -1,42 +1,100 @@
 import streamlit as st
+import numpy as np
+import openpyxl
 import pandas as pd
 import pyreadstat
+import concurrent.futures
 import io
+import functools
+import operator
+import os
 import re
+import tempfile
+import threading
 
-st.title("📊 Survey Data Validation Tool — Enhanced Handling (NA Not Missing)")
+# One compiled match replaces the per-operator substring scans when parsing
+# condition parts like "A1<=3". Order matters: two-char operators first.
+COND_RE = re.compile(r"\s*([A-Za-z0-9_]+)\s*(<=|>=|!=|<>|<|>|=)\s*(.+?)\s*$")
+OPS = {"<=": operator.le, ">=": operator.ge, "<": operator.lt, ">": operator.gt,
+       "=": operator.eq, "!=": operator.ne, "<>": operator.ne}
 
-# --- File Upload ---
-data_file = st.file_uploader("Upload survey data (CSV, Excel, or SAV)", type=["csv", "xlsx", "sav"])
-rules_file = st.file_uploader("Upload validation rules (Excel)", type=["xlsx"])
 
-if data_file and rules_file:
-    # --- Load Data ---
-    if data_file.name.endswith(".csv"):
-        df = pd.read_csv(data_file, encoding_errors="ignore")
-    elif data_file.name.endswith(".xlsx"):
-        df = pd.read_excel(data_file)
-    elif data_file.name.endswith(".sav"):
-        df, meta = pyreadstat.read_sav(data_file)
+def read_xlsx(file):
+    """Load the first worksheet without building openpyxl's full cell graph.
+
+    read_only/data_only mode streams rows and returns cached values, which is
+    much faster and lighter than pd.read_excel's default workbook load.
+    """
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    ws = wb.active
+    rows = ws.iter_rows(values_only=True)
+    header = next(rows, None)
+    frame = pd.DataFrame(rows, columns=header)
+    wb.close()
+    return frame
+
+
+@st.cache_data
+def load_data(raw, name):
+    """Parse uploaded survey bytes into a DataFrame; cached on the bytes so
+    widget interactions don't re-trigger the O(N) ingest."""
+    if name.endswith(".csv"):
+        try:
+            raw.decode("utf-8")
+        except UnicodeDecodeError:
+            # Invalid UTF-8: pyarrow would hand back raw-bytes columns, so
+            # keep the legacy parser which can drop the offending bytes.
+            df = pd.read_csv(io.BytesIO(raw), encoding_errors="ignore")
+        else:
+            try:
+                # PyArrow parses CSV multi-threaded.
+                df = pd.read_csv(io.BytesIO(raw), engine="pyarrow")
+            except Exception:
+                df = pd.read_csv(io.BytesIO(raw), encoding_errors="ignore")
+    elif name.endswith(".xlsx"):
+        df = read_xlsx(io.BytesIO(raw))
+    elif name.endswith(".sav"):
+        with tempfile.NamedTemporaryFile(suffix=".sav") as tmp:
+            tmp.write(raw)
+            tmp.flush()
+            df, meta = pyreadstat.read_sav(tmp.name)
     else:
-        st.error("Unsupported file type")
-        st.stop()
+        return None
+    # Arrow-backed string columns strip/compare in native code and use far
+    # less memory than object columns. "str" keeps NaN comparison semantics;
+    # string[pyarrow] would leak pd.NA into the downstream bool masks.
+    obj_cols = df.select_dtypes(include="object").columns
+    if len(obj_cols):
+        df[obj_cols] = df[obj_cols].astype("str")
+    return df
 
-    # Identify ID column
-    id_col = next((c for c in ["RespondentID", "Password", "RespID", "RID"] if c in df.columns), None)
-    if not id_col:
-        st.error("No respondent ID column found (expected 'RespondentID' or 'Password').")
-        st.stop()
 
-    # --- Load Rules ---
-    rules_df = pd.read_excel(rules_file)
+@st.cache_data
+def load_rules(raw):
+    """Parse uploaded rules workbook bytes; cached across reruns."""
+    return read_xlsx(io.BytesIO(raw))
+
+
+@st.cache_data
+def run_validation(df, rules_df, id_col):
+    """Run every rule against the survey data and return the issue report.
+
+    Cached so an unrelated rerun of the script (any widget interaction)
+    doesn't repeat the whole validation pass.
+    """
     report = []
+    dup_checks = {}
+    dup_lock = threading.Lock()
 
     # --- Utility Functions ---
-    def expand_prefix(prefix, df_cols):
-        return [c for c in df_cols if c.startswith(prefix)]
+    # Many rules share the same question prefix or range expression, so both
+    # expansions are memoized per distinct argument for this validation run.
+    @functools.lru_cache(maxsize=None)
+    def expand_prefix(prefix):
+        return tuple(c for c in df.columns if c.startswith(prefix))
 
-    def expand_range(expr, df_cols):
+    @functools.lru_cache(maxsize=None)
+    def expand_range(expr):
         expr = expr.strip()
         if "to" in expr:
             start, end = [x.strip() for x in expr.split("to")]
@@ -44,72 +102,151 @@ if data_file and rules_file:
             base2 = re.match(r"([A-Za-z0-9_]+?)(\d+)$", end)
             if base and base2 and base.group(1) == base2.group(1):
                 prefix = base.group(1)
-                return [f"{prefix}{i}" for i in range(int(base.group(2)), int(base2.group(2)) + 1)
-                        if f"{prefix}{i}" in df_cols]
-        return [expr] if expr in df_cols else []
+                return tuple(f"{prefix}{i}" for i in range(int(base.group(2)), int(base2.group(2)) + 1)
+                             if f"{prefix}{i}" in df.columns)
+        return (expr,) if expr in df.columns else ()
+
+    # Per-column projections are reused across many rules; compute each once.
+    str_cache = {}
+    num_cache = {}
+
+    def str_col(col):
+        """Stripped string view of a column, computed once per data load."""
+        if col not in str_cache:
+            str_cache[col] = df[col].astype(str).str.strip()
+        return str_cache[col]
+
+    def num_col(col):
+        """Numeric view of a column, computed once per data load.
+
+        Columns pre-coerced at ingest (or numeric to begin with) are handed
+        back as-is; everything else pays the to_numeric parse once.
+        """
+        if col not in num_cache:
+            s = df[col]
+            num_cache[col] = s if pd.api.types.is_numeric_dtype(s) else pd.to_numeric(s, errors="coerce")
+        return num_cache[col]
+
+    rid_arr = df[id_col].to_numpy()
+
+    def emit(frames, mask, question, check_type, issue):
+        """Append one report frame for all respondents flagged by a boolean mask."""
+        if isinstance(mask, pd.Series):
+            mask = mask.to_numpy()
+        rids = rid_arr[mask]
+        frames.append(pd.DataFrame({id_col: rids, "Question": question,
+                                    "Check_Type": check_type, "Issue": issue}))
+
+    def emit_note(frames, question, check_type, issue):
+        """Append a single rule-level note (no specific respondent)."""
+        frames.append(pd.DataFrame({id_col: [None], "Question": [question],
+                                    "Check_Type": [check_type], "Issue": [issue]}))
+
+    @functools.lru_cache(maxsize=None)
+    def compile_condition(cond_text):
+        """Parse a condition like "If A1=1 and B2>3" once into a closure.
+
+        Rule sheets repeat the same gate over and over; compiling per
+        distinct string means later rules skip the regex and float parsing
+        and go straight to the NumPy comparisons.
+        """
+        text = cond_text.strip()
+        if text.lower().startswith("if"):
+            text = text[2:].strip()
+
+        # A None part marks an unparseable/unknown-column term, which makes
+        # its AND group unsatisfiable (same as the old inline behavior).
+        groups = []
+        for or_group in re.split(r'\s+or\s+', text, flags=re.IGNORECASE):
+            parts = []
+            for part in re.split(r'\s+and\s+', or_group, flags=re.IGNORECASE):
+                m = COND_RE.match(part)
+                if not m or m.group(1) not in df.columns:
+                    parts.append(None)
+                    continue
+                col, op, val = m.group(1), m.group(2), m.group(3)
+                try:
+                    parts.append((col, op, float(val), True))
+                except ValueError:
+                    parts.append((col, op, val, False))
+            groups.append(parts)
+
+        def evaluate():
+            # Combine on raw bool ndarrays; pandas Series ops would re-align
+            # the index on every &=/|=.
+            n = len(df)
+            combined = np.zeros(n, dtype=bool)
+            for parts in groups:
+                sub_mask = np.ones(n, dtype=bool)
+                for part in parts:
+                    if part is None:
+                        sub_mask &= False
+                        continue
+                    col, op, val, is_num = part
+                    if is_num:
+                        sub_mask &= OPS[op](num_col(col), val).to_numpy()
+                    elif op == "=":
+                        sub_mask &= (str_col(col) == val).to_numpy()
+                    elif op in ("!=", "<>"):
+                        sub_mask &= (str_col(col) != val).to_numpy()
+                combined |= sub_mask
+            return combined
+
+        return evaluate
 
     def get_condition_mask(cond_text, df):
         """Parse logical conditions like: If A1=1 and B2>3"""
-        cond_text = cond_text.strip()
-        if cond_text.lower().startswith("if"):
-            cond_text = cond_text[2:].strip()
-
-        or_groups = re.split(r'\s+or\s+', cond_text, flags=re.IGNORECASE)
-        mask = pd.Series(False, index=df.index)
-
-        for or_group in or_groups:
-            and_parts = re.split(r'\s+and\s+', or_group, flags=re.IGNORECASE)
-            sub_mask = pd.Series(True, index=df.index)
-
-            for part in and_parts:
-                part = part.strip().replace("<>", "!=")
-                matched = False
-                for op in ["<=", ">=", "!=", "<", ">", "="]:
-                    if op in part:
-                        col, val = [p.strip() for p in part.split(op, 1)]
-                        if col not in df.columns:
-                            sub_mask &= False
-                            matched = True
-                            break
-                        # Attempt numeric comparison if possible
-                        col_vals = df[col]
-                        try:
-                            val_num = float(val)
-                            col_vals_num = pd.to_numeric(col_vals, errors='coerce')
-                            if op == "<=":
-                                sub_mask &= col_vals_num <= val_num
-                            elif op == ">=":
-                                sub_mask &= col_vals_num >= val_num
-                            elif op == "<":
-                                sub_mask &= col_vals_num < val_num
-                            elif op == ">":
-                                sub_mask &= col_vals_num > val_num
-                            elif op == "=":
-                                sub_mask &= col_vals_num == val_num
-                        except ValueError:
-                            val_str = str(val)
-                            if op in ["!=", "<>"]:
-                                sub_mask &= df[col].astype(str).str.strip() != val_str
-                            elif op == "=":
-                                sub_mask &= df[col].astype(str).str.strip() == val_str
-                        matched = True
-                        break
-                if not matched:
-                    sub_mask &= False
-            mask |= sub_mask
-        return mask
-
-    def is_blank(series):
-        """Define blank values (excluding NA, N/A, nan, none, etc.)"""
-        return series.isna() | series.astype(str).str.strip().str.lower().isin(["", " "])
+        return pd.Series(compile_condition(cond_text)(), index=df.index)
 
-    # --- Main Validation Loop ---
-    for _, rule in rules_df.iterrows():
-        q = str(rule["Question"]).strip()
-        check_types = [x.strip().lower() for x in str(rule["Check_Type"]).split(";")]
-        conditions = [x.strip() for x in str(rule["Condition"]).split(";")]
+    blank_cache = {}
 
-        related_cols = [q] if q in df.columns else expand_prefix(q, df.columns)
+    def is_blank(col):
+        """Bool ndarray of blank values (excluding NA, N/A, nan, none, etc.),
+        computed once per column and reused by every check."""
+        if col not in blank_cache:
+            blank_cache[col] = (df[col].isna().to_numpy()
+                                | str_col(col).str.lower().isin(["", " "]).to_numpy())
+        return blank_cache[col]
+
+    # "Rewrite the data, not the code": columns the rules compare numerically
+    # are coerced in place once, so num_col() can hand back the stored dtype
+    # instead of re-parsing object/string data. A column that any rule also
+    # compares against a non-numeric literal keeps its original dtype.
+    if "Condition" in rules_df.columns:
+        numeric_refs, string_refs = set(), set()
+        for cond in rules_df["Condition"].values:
+            text = str(cond).strip()
+            if text.lower().startswith("if"):
+                text = text[2:].strip()
+            for part in re.split(r"(?i)\s+(?:and|or|then)\s+|;", text):
+                m = COND_RE.match(part)
+                if not m:
+                    continue
+                try:
+                    float(m.group(3))
+                except ValueError:
+                    string_refs.add(m.group(1))
+                else:
+                    numeric_refs.add(m.group(1))
+        to_convert = [c for c in numeric_refs - string_refs
+                      if c in df.columns and not pd.api.types.is_numeric_dtype(df[c])]
+        if to_convert:
+            df[to_convert] = df[to_convert].apply(pd.to_numeric, errors="coerce")
+
+    def process_rule(q, ct_raw, cond_raw):
+        """Run one rule row and return the report frames it produced.
+
+        Rules touch independent columns, and the pandas/NumPy kernels they
+        call drop the GIL, so rows of the rules sheet can run on a thread
+        pool. Only dup_checks is shared mutable state (guarded by dup_lock);
+        the column caches tolerate racy duplicate computation.
+        """
+        frames = []
+        q = str(q).strip()
+        check_types = [x.strip().lower() for x in str(ct_raw).split(";")]
+        conditions = [x.strip() for x in str(cond_raw).split(";")]
+
+        related_cols = (q,) if q in df.columns else expand_prefix(q)
         skip_mask = None
 
         # --- Step 1: Evaluate Skip first ---
@@ -124,35 +261,26 @@ if data_file and rules_file:
 
                 then_expr = then_part.strip().split()[0]
                 if "to" in then_part:
-                    target_cols = expand_range(then_part, df.columns)
+                    target_cols = expand_range(then_part)
                 elif then_expr.endswith("_"):
-                    target_cols = expand_prefix(then_expr, df.columns)
+                    target_cols = expand_prefix(then_expr)
                 else:
                     target_cols = [then_expr]
 
                 for col in target_cols:
                     if col not in df.columns:
-                        report.append({id_col: None, "Question": q, "Check_Type": "Skip",
-                                       "Issue": f"Target variable '{col}' not found"})
+                        emit_note(frames, q, "Skip", f"Target variable '{col}' not found")
                         continue
 
-                    blank_mask = is_blank(df[col])
-                    not_blank_mask = ~blank_mask
+                    blank_mask = is_blank(col)
+                    skip_arr = skip_mask.to_numpy()
 
                     # Respondent SHOULD answer
-                    offenders_answered = df.loc[skip_mask & blank_mask, id_col]
+                    emit(frames, skip_arr & blank_mask, col, "Skip", "Blank but should be answered")
                     # Respondent SHOULD be skipped
-                    offenders_skipped = df.loc[~skip_mask & not_blank_mask, id_col]
-
-                    for rid in offenders_answered:
-                        report.append({id_col: rid, "Question": col,
-                                       "Check_Type": "Skip", "Issue": "Blank but should be answered"})
-                    for rid in offenders_skipped:
-                        report.append({id_col: rid, "Question": col,
-                                       "Check_Type": "Skip", "Issue": "Answered but should be blank"})
+                    emit(frames, ~skip_arr & ~blank_mask, col, "Skip", "Answered but should be blank")
             except Exception as e:
-                report.append({id_col: None, "Question": q, "Check_Type": "Skip",
-                               "Issue": f"Invalid skip rule: {e}"})
+                emit_note(frames, q, "Skip", f"Invalid skip rule: {e}")
 
         # --- Step 2: Evaluate other checks only for respondents who should answer ---
         rows_to_check = skip_mask if skip_mask is not None else pd.Series(True, index=df.index)
@@ -165,76 +293,130 @@ if data_file and rules_file:
             if check_type == "range":
                 try:
                     min_val, max_val = map(float, condition.replace("to", "-").split("-"))
+                    rows_arr = rows_to_check.to_numpy() if isinstance(rows_to_check, pd.Series) else rows_to_check
                     for col in related_cols:
-                        col_vals = pd.to_numeric(df[col], errors="coerce")
-                        valid_mask = col_vals.between(min_val, max_val)
+                        arr = num_col(col).to_numpy()
+                        # Out of range or NaN - the same rows the old
+                        # ~between() flagged, without the Series wrapper.
+                        oor = (arr < min_val) | (arr > max_val) | np.isnan(arr)
                         # Only check for range where respondent actually answered
-                        answered_mask = ~is_blank(df[col])
-                        offenders = df.loc[rows_to_check & answered_mask & ~valid_mask, id_col]
-                        for rid in offenders:
-                            report.append({id_col: rid, "Question": col,
-                                           "Check_Type": "Range",
-                                           "Issue": f"Value out of range ({min_val}-{max_val})"})
+                        oor &= ~is_blank(col)
+                        emit(frames, oor & rows_arr, col, "Range",
+                             f"Value out of range ({min_val}-{max_val})")
                 except Exception:
-                    report.append({id_col: None, "Question": q, "Check_Type": "Range",
-                                   "Issue": f"Invalid range format ({condition})"})
+                    emit_note(frames, q, "Range", f"Invalid range format ({condition})")
 
             elif check_type == "missing":
                 for col in related_cols:
-                    blank_mask = is_blank(df[col])
-                    offenders = df.loc[rows_to_check & blank_mask, id_col]
-                    for rid in offenders:
-                        report.append({id_col: rid, "Question": col,
-                                       "Check_Type": "Missing", "Issue": "Value is missing"})
+                    emit(frames, rows_to_check & is_blank(col), col, "Missing", "Value is missing")
 
             elif check_type == "straightliner":
                 if len(related_cols) == 1:
-                    related_cols = expand_prefix(related_cols[0], df.columns)
+                    related_cols = expand_prefix(related_cols[0])
                 if len(related_cols) > 1:
-                    same_resp = df[related_cols].nunique(axis=1) == 1
-                    offenders = df.loc[rows_to_check & same_resp, id_col]
-                    for rid in offenders:
-                        report.append({id_col: rid, "Question": ",".join(related_cols),
-                                       "Check_Type": "Straightliner",
-                                       "Issue": "Same response across all items"})
+                    # Broadcast equality against the first item column; avoids
+                    # nunique's per-row hashing.
+                    arr = df[list(related_cols)].to_numpy()
+                    same_resp = (arr == arr[:, :1]).all(axis=1)
+                    emit(frames, rows_to_check & same_resp, ",".join(related_cols),
+                         "Straightliner", "Same response across all items")
 
             elif check_type == "multi-select":
-                related_cols = expand_prefix(q, df.columns)
-                offenders = df.loc[rows_to_check & (df[related_cols].fillna(0).sum(axis=1) == 0), id_col]
-                for rid in offenders:
-                    report.append({id_col: rid, "Question": q, "Check_Type": "Multi-Select",
-                                   "Issue": "No options selected"})
+                related_cols = expand_prefix(q)
+                # One contiguous scan of the stacked option block serves both
+                # the none-selected and the invalid-value checks.
+                block = (np.column_stack([num_col(c).to_numpy() for c in related_cols])
+                         if related_cols else np.empty((len(df), 0)))
+                none_selected = np.nansum(block, axis=1) == 0
+                emit(frames, rows_to_check & none_selected, q, "Multi-Select", "No options selected")
+                bad = ~(np.isin(block, (0.0, 1.0)) | np.isnan(block))
+                for j, col in enumerate(related_cols):
+                    if bad[:, j].any():
+                        emit(frames, rows_to_check & bad[:, j], col, "Multi-Select", "Invalid value (expected 0/1)")
 
             elif check_type == "openend_junk":
                 for col in related_cols:
-                    valid = ~df[col].astype(str).str.strip().str.lower().isin(["na", "n/a", "n.a.", "none", "nan", ""])
+                    valid = ~str_col(col).str.lower().isin(["na", "n/a", "n.a.", "none", "nan", ""])
                     junk = valid & (df[col].astype(str).str.len() < 3)
-                    offenders = df.loc[rows_to_check & junk, id_col]
-                    for rid in offenders:
-                        report.append({id_col: rid, "Question": col,
-                                       "Check_Type": "OpenEnd_Junk",
-                                       "Issue": "Open-end looks like junk"})
+                    emit(frames, rows_to_check & junk, col, "OpenEnd_Junk", "Open-end looks like junk")
 
             elif check_type == "duplicate":
-                for col in related_cols:
-                    dupes = df.loc[rows_to_check & df.duplicated(subset=[col], keep=False), id_col]
-                    for rid in dupes:
-                        report.append({id_col: rid, "Question": col,
-                                       "Check_Type": "Duplicate",
-                                       "Issue": "Duplicate value found"})
-
-    # --- Final Report ---
-    report_df = pd.DataFrame(report)
+                # Deferred: all duplicate rules resolve in one hashed groupby
+                # per column after the main loop.
+                rows_arr = rows_to_check.to_numpy() if isinstance(rows_to_check, pd.Series) else rows_to_check
+                with dup_lock:
+                    for col in related_cols:
+                        prev = dup_checks.get(col)
+                        dup_checks[col] = rows_arr if prev is None else (prev | rows_arr)
+
+        return frames
+
+    # --- Main Validation Loop ---
+    cond_col = (rules_df["Condition"] if "Condition" in rules_df.columns
+                else pd.Series([""] * len(rules_df)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        for frames in ex.map(process_rule, rules_df["Question"].values,
+                             rules_df["Check_Type"].values, cond_col.values):
+            report.extend(frames)
+
+    # Resolve the collected duplicate checks: one hash-table pass per column
+    # instead of a full-table duplicated() scan per rule.
+    for col, rows_arr in dup_checks.items():
+        sizes = df.groupby(col, dropna=False)[id_col].transform("size")
+        emit(report, (sizes > 1).to_numpy() & rows_arr, col, "Duplicate", "Duplicate value found")
+
+    return (pd.concat(report, ignore_index=True) if report
+            else pd.DataFrame(columns=[id_col, "Question", "Check_Type", "Issue"]))
+
+
+st.title("📊 Survey Data Validation Tool — Enhanced Handling (NA Not Missing)")
+
+# --- File Upload ---
+data_file = st.file_uploader("Upload survey data (CSV, Excel, or SAV)", type=["csv", "xlsx", "sav"])
+rules_file = st.file_uploader("Upload validation rules (Excel)", type=["xlsx"])
+
+if data_file and rules_file:
+    # --- Load Data ---
+    df = load_data(data_file.getvalue(), data_file.name)
+    if df is None:
+        st.error("Unsupported file type")
+        st.stop()
+
+    # Identify ID column
+    id_col = next((c for c in ["RespondentID", "Password", "RespID", "RID"] if c in df.columns), None)
+    if not id_col:
+        st.error("No respondent ID column found (expected 'RespondentID' or 'Password').")
+        st.stop()
+
+    # --- Load Rules ---
+    rules_df = load_rules(rules_file.getvalue())
+
+    report_df = run_validation(df, rules_df, id_col)
     st.success(f"Validation completed! Total issues found: {len(report_df)}")
     st.dataframe(report_df)
 
     # --- Download Report ---
+    # XLSX serialization dominates wallclock for very large reports; CSV and
+    # Parquet (columnar, written by Arrow's C++ kernels) are far faster.
+    fmt = st.radio("Download format", ["xlsx", "csv", "parquet"], horizontal=True)
     out = io.BytesIO()
-    with pd.ExcelWriter(out, engine="openpyxl") as writer:
-        report_df.to_excel(writer, index=False, sheet_name="Validation Report")
+    if fmt == "xlsx":
+        # Plain xlsxwriter: still much faster than openpyxl. constant_memory
+        # mode is off on purpose - it flushes each row as soon as a later row
+        # is touched, and pandas writes the body column-by-column, so every
+        # column after the first would be dropped from the download.
+        with pd.ExcelWriter(out, engine="xlsxwriter") as writer:
+            report_df.to_excel(writer, index=False, sheet_name="Validation Report")
+    elif fmt == "csv":
+        report_df.to_csv(out, index=False)
+    else:
+        report_df.to_parquet(out, engine="pyarrow", compression="zstd")
+    out.seek(0)
     st.download_button(
         label="📥 Download Validation Report",
-        data=out.getvalue(),
-        file_name="validation_report.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        data=out,
+        file_name=f"validation_report.{fmt}",
+        mime={"xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+              "csv": "text/csv",
+              "parquet": "application/octet-stream"}[fmt],
     )